@@ -201,6 +201,23 @@ def default() -> ml_collections.ConfigDict:
           'method': 'hf',  # Method is one of 'hf', or 'direct_init'.
           'iterations': 1000,  # Only used if method is 'hf'.
           'basis': 'sto-6g',
+          # If true, evaluate the Hartree-Fock orbitals on device using a JAX
+          # implementation of the basis set rather than using PySCF on host.
+          'jax_hf_orbitals': False,
+          # If true, evaluate the envelope over the batch sequentially using
+          # jax.lax.map rather than jax.vmap to reduce memory usage. Only
+          # applies to post-determinant envelopes (e.g. output, exact_cusp),
+          # not the default isotropic envelope.
+          'use_lax_map': False,
+          # Number of MCMC moves to make in each pretraining iteration.
+          'mcmc_steps': 1,
+          # If true, evaluate the layers of the network in bfloat16 during
+          # pretraining. The input features, envelope, loss and optimisation
+          # remain in float32.
+          'bfloat16_orbitals': False,
+          # Number of iterations to run on device between transferring the
+          # losses to host. Only used if jax_hf_orbitals is true.
+          'scan_iterations': 1,
       },
   })
 
@@ -595,6 +595,12 @@ def fermi_net_orbitals(
   ae, ee, r_ae, r_ee = construct_input_features(pos, atoms)
   ae_features, ee_features = options.feature_layer.apply(
       ae=ae, r_ae=r_ae, ee=ee, r_ee=r_ee, **params['input'])
+  # The input features are constructed at the precision of the electron
+  # positions, but the layers are evaluated at the precision of the network
+  # weights (e.g. bfloat16 during pretraining, see pretrain.make_pretrain_step).
+  dtype = params['orbital'][0]['w'].dtype
+  ae_features = ae_features.astype(dtype)
+  ee_features = ee_features.astype(dtype)
 
   h_one = ae_features  # single-electron features
   h_two = ee_features  # two-electron features
@@ -621,7 +627,7 @@ def fermi_net_orbitals(
   if options.envelope.apply_type == envelopes.EnvelopeType.PRE_ORBITAL:
     envelope_factor = options.envelope.apply(
         ae=ae, r_ae=r_ae, r_ee=r_ee, **params['envelope'])
-    h_to_orbitals = envelope_factor * h_to_orbitals
+    h_to_orbitals = (envelope_factor * h_to_orbitals).astype(dtype)
   # Note split creates arrays of size 0 for spin channels without any electrons.
   h_to_orbitals = jnp.split(
       h_to_orbitals, network_blocks.array_partitions(nspins), axis=0)
@@ -34,9 +34,8 @@ class PbcHamiltonianTest(parameterized.TestCase):
     nspins = (6, 5)
     atoms = jnp.asarray([[0., 0., 0.2], [1.2, 1., -0.2], [2.5, -0.8, 0.6]])
     charges = jnp.asarray([2, 5, 7])
-    key = jax.random.PRNGKey(42)
-    key, subkey = jax.random.split(key)
-    xs = jax.random.uniform(subkey, shape=(sum(nspins), 3))
+    keys = jax.random.split(jax.random.PRNGKey(42), 6)
+    xs = jax.random.uniform(keys[0], shape=(sum(nspins), 3))
 
     feature_layer = pbc_feature_layer.make_pbc_feature_layer(
         charges, nspins, ndim=3, lattice=jnp.eye(3), include_r_ae=False)
@@ -55,8 +54,7 @@ class PbcHamiltonianTest(parameterized.TestCase):
         full_det=cfg.network.full_det,
         **cfg.network.detnet)
 
-    key, subkey = jax.random.split(key)
-    params = network_init(subkey)
+    params = network_init(keys[1])
 
     local_energy = hamiltonian.local_energy(
         f=signed_network,
@@ -66,19 +64,17 @@ class PbcHamiltonianTest(parameterized.TestCase):
         use_scan=False,
         lattice=jnp.eye(3),
         heg=False)
+    # Compile once so both evaluations below reuse the same executable.
+    local_energy = jax.jit(local_energy)
 
-    key, subkey = jax.random.split(key)
-    e1 = local_energy(params, subkey, xs.flatten())
+    e1 = local_energy(params, keys[2], xs.flatten())
 
     # Select random electron coordinate to displace by a random lattice vec
-    key, subkey = jax.random.split(key)
-    e_idx = jax.random.randint(subkey, (1,), 0, xs.shape[0])
-    key, subkey = jax.random.split(key)
-    randvec = jax.random.randint(subkey, (3,), 0, 100).astype(jnp.float32)
+    e_idx = jax.random.randint(keys[3], (1,), 0, xs.shape[0])
+    randvec = jax.random.randint(keys[4], (3,), 0, 100).astype(jnp.float32)
     xs = xs.at[e_idx].add(randvec)
 
-    key, subkey = jax.random.split(key)
-    e2 = local_energy(params, subkey, xs.flatten())
+    e2 = local_energy(params, keys[5], xs.flatten())
 
     atol, rtol = 4.e-3, 4.e-3
     np.testing.assert_allclose(e1, e2, atol=atol, rtol=rtol)
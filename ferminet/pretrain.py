@@ -14,6 +14,7 @@
 
 """Utilities for pretraining and importing PySCF models."""
 
+from concurrent import futures
 from typing import Callable, Optional, Sequence, Tuple, Union
 
 from absl import logging
@@ -25,6 +26,7 @@ from ferminet import networks
 from ferminet.utils import scf
 from ferminet.utils import system
 import jax
+from jax import lax
 from jax import numpy as jnp
 import kfac_jax
 import numpy as np
@@ -38,6 +40,10 @@ import pyscf
 FermiNetOrbitals = Callable[[networks.ParamTree, jnp.ndarray],
                             Sequence[jnp.ndarray]]
 
+# Given electron positions, return the matrices of HF orbitals for the spin up
+# and spin down electrons. See make_eval_orbitals.
+HartreeFockOrbitals = Callable[[jnp.ndarray], Tuple[jnp.ndarray, jnp.ndarray]]
+
 
 def get_hf(molecule: Optional[Sequence[system.Atom]] = None,
            nspins: Optional[Tuple[int, int]] = None,
@@ -81,11 +87,8 @@ def eval_orbitals(scf_approx: scf.Scf, pos: Union[np.ndarray, jnp.ndarray],
     tuple with matrices of orbitals for spin up and spin down electrons, with
     the same leading dimensions as in pos.
   """
-  if not isinstance(pos, np.ndarray):  # works even with JAX array
-    try:
-      pos = pos.copy()
-    except AttributeError as exc:
-      raise ValueError('Input must be either NumPy or JAX array.') from exc
+  # Single transfer of a JAX array to host; no copy of a NumPy array.
+  pos = np.asarray(pos)
   leading_dims = pos.shape[:-1]
   # split into separate electrons
   pos = np.reshape(pos, [-1, 3])  # (batch*nelec, 3)
@@ -99,6 +102,35 @@ def eval_orbitals(scf_approx: scf.Scf, pos: Union[np.ndarray, jnp.ndarray],
   return alpha_spin, beta_spin
 
 
+def make_eval_orbitals(scf_approx: scf.Scf,
+                       nspins: Tuple[int, int]) -> HartreeFockOrbitals:
+  """Creates a JAX function to evaluate SCF orbitals at a set of positions.
+
+  Args:
+    scf_approx: an scf.Scf object that contains the result of a PySCF
+      calculation.
+    nspins: tuple with number of spin up and spin down electrons.
+
+  Returns:
+    Callable with signature f(pos), which returns the same as eval_orbitals but
+    can be jitted, vmapped and pmapped.
+  """
+  eval_mos = scf_approx.make_jax_eval_mos()
+
+  def eval_orbitals_fn(pos: jnp.ndarray) -> Tuple[jnp.ndarray, jnp.ndarray]:
+    leading_dims = pos.shape[:-1]
+    # split into separate electrons
+    pos = jnp.reshape(pos, [-1, 3])  # (batch*nelec, 3)
+    mos = eval_mos(pos)  # (batch*nelec, nbasis), (batch*nelec, nbasis)
+    # Reshape into (batch, nelec, nbasis) for each spin channel.
+    mos = [jnp.reshape(mo, leading_dims + (sum(nspins), -1)) for mo in mos]
+    alpha_spin = mos[0][..., :nspins[0], :nspins[0]]
+    beta_spin = mos[1][..., nspins[0]:, :nspins[1]]
+    return alpha_spin, beta_spin
+
+  return eval_orbitals_fn
+
+
 def eval_slater(scf_approx: scf.Scf, pos: Union[jnp.ndarray, np.ndarray],
                 nspins: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
   """Evaluates the Slater determinant.
@@ -112,78 +144,221 @@ def eval_slater(scf_approx: scf.Scf, pos: Union[jnp.ndarray, np.ndarray],
     tuple with sign and log absolute value of Slater determinant.
   """
   matrices = eval_orbitals(scf_approx, pos, nspins)
-  slogdets = [np.linalg.slogdet(elem) for elem in matrices]
-  sign_alpha, sign_beta = [elem[0] for elem in slogdets]
-  log_abs_wf_alpha, log_abs_wf_beta = [elem[1] for elem in slogdets]
+  # slogdet is batched over the leading dimensions, so one LAPACK call per spin.
+  sign_alpha, log_abs_wf_alpha = np.linalg.slogdet(matrices[0])
+  sign_beta, log_abs_wf_beta = np.linalg.slogdet(matrices[1])
   log_abs_slater_determinant = log_abs_wf_alpha + log_abs_wf_beta
   sign = sign_alpha * sign_beta
   return sign, log_abs_slater_determinant
 
 
+def make_batch_envelope_fn(envelope: envelopes.Envelope,
+                           atoms: jnp.ndarray,
+                           use_lax_map: bool = False):
+  """Creates function for evaluating the envelope over a batch of positions.
+
+  Args:
+    envelope: envelope used in the network.
+    atoms: (natom, 3) array of atom positions.
+    use_lax_map: If true, evaluate the envelope sequentially over the batch
+      with jax.lax.map rather than vectorising it with jax.vmap. Only applies
+      to post-determinant envelopes.
+
+  Returns:
+    Callable with signature f(params, data), which given the tree of envelope
+    parameters and a batch of electron positions, returns the log of the
+    multiplicative envelope to apply to the orbitals for each configuration.
+    This is zero if the envelope is already applied within the orbitals (i.e.
+    is not a post-determinant envelope).
+  """
+  if envelope.apply_type != envelopes.EnvelopeType.POST_DETERMINANT:
+    if use_lax_map:
+      logging.warning('use_lax_map has no effect: the envelope is evaluated '
+                      'within the network orbitals.')
+    return lambda p, x: jnp.zeros(x.shape[:1])
+
+  def envelope_fn(params, ae, r_ae, r_ee):
+    return envelope.apply(ae=ae, r_ae=r_ae, r_ee=r_ee, **params)
+
+  if use_lax_map:
+    batch_apply_envelope = lambda p, *features: jax.lax.map(
+        lambda f: envelope_fn(p, *f), features)
+  else:
+    batch_apply_envelope = jax.vmap(envelope_fn, (None, 0, 0, 0))
+  batch_input_features = jax.vmap(networks.construct_input_features, (0, None))
+
+  def batch_envelope_fn(params, x):
+    # Construct the input features for the whole batch at once, outside of
+    # the (possibly sequential) map over the envelope.
+    ae, _, r_ae, r_ee = batch_input_features(x, atoms)
+    return batch_apply_envelope(params, ae, r_ae, r_ee)
+
+  return batch_envelope_fn
+
+
 def make_pretrain_step(batch_envelope_fn,
                        batch_orbitals: FermiNetOrbitals,
-                       batch_network: networks.LogFermiNetLike,
                        optimizer_update: optax.TransformUpdateFn,
-                       full_det: bool = False):
+                       full_det: bool = False,
+                       eval_orbitals_fn: Optional[HartreeFockOrbitals] = None,
+                       bfloat16_orbitals: bool = False):
   """Creates function for performing one step of Hartre-Fock pretraining.
 
+  The MCMC configurations are updated separately (see
+  make_pretrain_mcmc_step), so that the HF orbitals at the next set of
+  configurations can be evaluated on host while the optimisation step runs.
+
   Args:
     batch_envelope_fn: callable with signature f(params, data) which, given a
       batch of electron positions and the tree of envelope network parameters,
-      returns the multiplicative envelope to apply to the orbitals. See envelope
-      functions in networks for details. Only required if the envelope is not
+      returns the multiplicative envelope to apply to the orbitals. See
+      make_batch_envelope_fn for details. Only required if the envelope is not
       included in batch_orbitals.
     batch_orbitals: callable with signature f(params, data), which given network
       parameters and a batch of electron positions, returns the orbitals in
       the network evaluated at those positions.
-    batch_network: callable with signature f(params, data), which given network
-      parameters and a batch of electron positions, returns the log of the
-      magnitude of the (wavefunction) network  evaluated at those positions.
     optimizer_update: callable for transforming the gradients into an update (ie
       conforms to the optax API).
     full_det: If true, evaluate all electrons in a single determinant.
       Otherwise, evaluate products of alpha- and beta-spin determinants.
+    eval_orbitals_fn: If given, JAX function (see make_eval_orbitals) used to
+      evaluate the target HF orbitals within the step, in which case the
+      target passed to the step is ignored.
+    bfloat16_orbitals: If true, evaluate the layers of the network in bfloat16
+      by casting all parameters except those of the envelope. The input
+      features are constructed from the electron positions and the envelope is
+      evaluated in float32, as are the loss, gradients and optimizer state.
 
   Returns:
     Callable for performing a single pretraining optimisation step.
   """
 
-  def pretrain_step(data, target, params, state, key, logprob):
+  @jax.jit
+  def pretrain_step(data, target, params, state):
     """One iteration of pretraining to match HF."""
-    n = jnp.array([tgt.shape[-1] for tgt in target]).sum()
+    if eval_orbitals_fn is not None:
+      target = eval_orbitals_fn(data)
+    # Static under tracing, so the envelope rescaling folds into the graph.
+    n = sum(tgt.shape[-1] for tgt in target)
+    if full_det:
+      # The target does not depend on the parameters, so construct the block
+      # diagonal matrix of the alpha and beta orbitals outside of loss_fn and
+      # its gradient, in a single allocation.
+      ndet = target[0].shape[0]
+      na = target[0].shape[1]
+      nb = target[1].shape[1]
+      target = (
+          jnp.zeros((ndet, na + nb, na + nb))
+          .at[:, :na, :na].set(target[0])
+          .at[:, na:, na:].set(target[1]))
 
     def loss_fn(p, x, target):
-      env = jnp.exp(batch_envelope_fn(p['envelope'], x) / n)
-      env = jnp.reshape(env, [env.shape[-1], 1, 1, 1])
+      env = batch_envelope_fn(p['envelope'], x)
+      if env.ndim != 1:
+        raise ValueError(
+            f'Expected an envelope of shape (batch,), got shape {env.shape}.')
+      env = jnp.exp(env / n)
+      env = env[:, None, None, None]  # broadcast over (ndet, norb, norb)
+      # The orbital forward pass dominates the cost of the step: evaluate once.
+      if bfloat16_orbitals:
+        # The network casts its input features to the dtype of its weights.
+        to_bfloat16 = lambda y: y.astype(jnp.bfloat16)
+        p_orbitals = {
+            k: v if k == 'envelope' else jax.tree_util.tree_map(to_bfloat16, v)
+            for k, v in p.items()
+        }
+        orbs = batch_orbitals(p_orbitals, x)
+        orbs = [o.astype(jnp.float32) for o in orbs]
+      else:
+        orbs = batch_orbitals(p, x)
       if full_det:
-        ndet = target[0].shape[0]
-        na = target[0].shape[1]
-        nb = target[1].shape[1]
-        target = jnp.concatenate(
-            (jnp.concatenate((target[0], jnp.zeros((ndet, na, nb))), axis=-1),
-             jnp.concatenate((jnp.zeros((ndet, nb, na)), target[1]), axis=-1)),
-            axis=-2)
-        result = jnp.mean(
-            (target[:, None, ...] - env * batch_orbitals(p, x)[0])**2)
+        result = jnp.mean((target[:, None, ...] - env * orbs[0])**2)
       else:
-        result = jnp.array([
+        # Spin channels without electrons are not returned by the network, so
+        # sum over the zipped channels rather than assuming both are present.
+        result = sum(
             jnp.mean((t[:, None, ...] - env * o)**2)
-            for t, o in zip(target, batch_orbitals(p, x))
-        ]).sum()
-      return constants.pmean(result)
+            for t, o in zip(target, orbs))
+      return result
 
     val_and_grad = jax.value_and_grad(loss_fn, argnums=0)
     loss_val, search_direction = val_and_grad(params, data, target)
-    search_direction = constants.pmean(search_direction)
+    # Average the loss and gradients across devices in a single reduction,
+    # rather than also differentiating through a reduction in loss_fn.
+    loss_val, search_direction = constants.pmean((loss_val, search_direction))
     updates, state = optimizer_update(search_direction, state, params)
     params = optax.apply_updates(params, updates)
-    data, key, logprob, _ = mcmc.mh_update(params, batch_network, data, key,
-                                           logprob, 0)
-    return data, params, state, loss_val, logprob
+    return params, state, loss_val
 
   return pretrain_step
 
 
+def make_pretrain_mcmc_step(batch_network: networks.LogFermiNetLike,
+                            steps: int = 1):
+  """Creates function for updating the MCMC configurations during pretraining.
+
+  Args:
+    batch_network: callable with signature f(params, data), which given network
+      parameters and a batch of electron positions, returns the log of the
+      magnitude of the (wavefunction) network  evaluated at those positions.
+    steps: Number of Metropolis-Hastings moves to attempt in a single call.
+
+  Returns:
+    Callable for performing a set of Metropolis-Hastings moves.
+  """
+
+  @jax.jit
+  def pretrain_mcmc_step(params, data, key, logprob):
+    """Moves the MCMC configurations to sample from the current network."""
+
+    def step_fn(i, x):
+      return mcmc.mh_update(params, batch_network, *x, i=i)
+
+    data, _, logprob, _ = lax.fori_loop(0, steps, step_fn,
+                                        (data, key, logprob, 0.))
+    return data, logprob
+
+  return pretrain_mcmc_step
+
+
+def make_pretrain_scan(pretrain_mcmc_step, pretrain_step):
+  """Creates function for performing several pretraining iterations on device.
+
+  Only applicable if the HF orbitals are evaluated within the optimisation step
+  (see make_pretrain_step), as then no host computation is required between
+  iterations.
+
+  Args:
+    pretrain_mcmc_step: callable for updating the MCMC configurations (see
+      make_pretrain_mcmc_step).
+    pretrain_step: callable for performing a single pretraining optimisation
+      step, created with eval_orbitals_fn (see make_pretrain_step).
+
+  Returns:
+    Callable with signature f(params, state, data, key, logprob, iterations)
+    which performs the given (static) number of pretraining iterations using
+    jax.lax.scan, and returns the updated params, state, data, key and logprob
+    and the loss at each iteration.
+  """
+
+  def pretrain_scan(params, state, data, key, logprob, iterations):
+
+    def scan_body(carry, _):
+      params, state, data, key, logprob = carry
+      # Same sequence of RNG keys, MCMC moves and optimisation steps as the
+      # per-iteration loop in pretrain_hartree_fock.
+      key, subkey = jax.random.split(key)
+      new_data, logprob = pretrain_mcmc_step(params, data, subkey, logprob)
+      params, state, loss = pretrain_step(data, None, params, state)
+      return (params, state, new_data, key, logprob), loss
+
+    carry, losses = lax.scan(
+        scan_body, (params, state, data, key, logprob), None, length=iterations)
+    return carry + (losses,)
+
+  return pretrain_scan
+
+
 def pretrain_hartree_fock(
     *,
     params: networks.ParamTree,
@@ -197,11 +372,25 @@ def pretrain_hartree_fock(
     scf_approx: scf.Scf,
     iterations: int = 1000,
     logger: Optional[Callable[[int, float], None]] = None,
+    jax_hf_orbitals: bool = False,
+    use_lax_map: bool = False,
+    mcmc_steps: int = 1,
+    bfloat16_orbitals: bool = False,
+    scan_iterations: int = 1,
 ):
   """Performs training to match initialization as closely as possible to HF.
 
+  In each iteration, the MCMC configurations are moved using the parameters
+  from before that iteration's optimisation step, and the optimisation step is
+  then performed on the configurations from before the move. This allows the HF
+  orbitals at the new configurations to be evaluated whilst the optimisation
+  step runs, but means the sampled configurations, and hence the losses after
+  the first iteration, differ from moving the configurations with the updated
+  parameters.
+
   Args:
-    params: Network parameters.
+    params: Network parameters. The buffers are donated to the pretraining
+      step, so params must not be used by the caller afterwards.
     data: MCMC configurations.
     batch_network: callable with signature f(params, data), which given network
       parameters and a batch of electron positions, returns the log of the
@@ -218,47 +407,105 @@ def pretrain_hartree_fock(
     iterations: number of pretraining iterations to perform.
     logger: Callable with signature (step, value) which externally logs the
       pretraining loss.
+    jax_hf_orbitals: If true, evaluate the HF orbitals on device using a JAX
+      implementation of the basis set rather than using PySCF on host.
+    use_lax_map: If true, evaluate the envelope sequentially over the batch
+      with jax.lax.map rather than vectorising it with jax.vmap. This reduces
+      peak memory usage for large batches at the cost of less parallelism.
+      Only applies to post-determinant envelopes (e.g. the output and exact
+      cusp envelopes); other envelopes, including the default isotropic
+      envelope, are evaluated within batch_orbitals and are unaffected.
+    mcmc_steps: number of Metropolis-Hastings moves to make to the MCMC
+      configurations in each pretraining iteration.
+    bfloat16_orbitals: If true, evaluate the layers of the network (including
+      all their matrix multiplications) in bfloat16 when fitting the orbitals
+      to the HF orbitals, which can reduce the cost of each step on
+      accelerators with native bfloat16 support. The input features and the
+      envelope are evaluated in float32. The loss is only approximately the
+      float32 loss. Only used for pretraining.
+    scan_iterations: number of pretraining iterations to run on device in a
+      single jax.lax.scan if jax_hf_orbitals is true. The losses are only
+      transferred to host, and logged, after each block of iterations. Ignored
+      if jax_hf_orbitals is false, as the HF orbitals are then evaluated by
+      PySCF on host in each iteration.
 
   Returns:
     params, data: Updated network parameters and MCMC configurations such that
     the orbitals in the network closely match Hartree-Foch and the MCMC
     configurations are drawn from the log probability of the network.
   """
-  # Pretraining is slow on larger systems (very low GPU utilization) because the
-  # Hartree-Fock orbitals are evaluated on CPU and only on a single host.
-  # Implementing the basis set in JAX would enable using GPUs and allow
-  # eval_orbitals to be pmapped.
+  # Pretraining is slow on larger systems (very low GPU utilization) if the
+  # Hartree-Fock orbitals are evaluated by PySCF, which is on CPU and only on a
+  # single host. Set jax_hf_orbitals to evaluate them on device instead.
 
   optimizer = optax.adam(3.e-4)
   opt_state_pt = constants.pmap(optimizer.init)(params)
 
-  if (network_options.envelope.apply_type ==
-      envelopes.EnvelopeType.POST_DETERMINANT):
-
-    def envelope_fn(params, x):
-      ae, r_ae, _, r_ee = networks.construct_input_features(x, atoms)
-      return network_options.envelope.apply(
-          ae=ae, r_ae=r_ae, r_ee=r_ee, **params)
-  else:
-    envelope_fn = lambda p, x: 0.0
-  batch_envelope_fn = jax.vmap(envelope_fn, (None, 0))
-
   pretrain_step = make_pretrain_step(
-      batch_envelope_fn,
+      make_batch_envelope_fn(
+          network_options.envelope, atoms, use_lax_map=use_lax_map),
       batch_orbitals,
-      batch_network,
       optimizer.update,
-      full_det=network_options.full_det)
-  pretrain_step = constants.pmap(pretrain_step)
-  pnetwork = constants.pmap(batch_network)
-  logprob = 2. * pnetwork(params, data)
-
-  for t in range(iterations):
-    target = eval_orbitals(scf_approx, data, electrons)
-    sharded_key, subkeys = kfac_jax.utils.p_split(sharded_key)
-    data, params, opt_state_pt, loss, logprob = pretrain_step(
-        data, target, params, opt_state_pt, subkeys, logprob)
-    logging.info('Pretrain iter %05d: %g', t, loss[0])
+      full_det=network_options.full_det,
+      eval_orbitals_fn=(make_eval_orbitals(scf_approx, electrons)
+                        if jax_hf_orbitals else None),
+      bfloat16_orbitals=bfloat16_orbitals)
+  # Scale inside the pmapped function so initialising the log probabilities is
+  # a single computation on device, without a separately dispatched multiply.
+  plogprob = constants.pmap(lambda p, x: 2. * batch_network(p, x))
+  logprob = plogprob(params, data)
+  pretrain_mcmc_step = make_pretrain_mcmc_step(batch_network, steps=mcmc_steps)
+
+  def log_loss(t, loss):
+    logging.info('Pretrain iter %05d: %g', t, loss)
     if logger:
-      logger(t, loss[0])
+      logger(t, loss)
+
+  if jax_hf_orbitals:
+    # No host computation is required between iterations, so run blocks of
+    # iterations on device and only transfer the losses to host after each
+    # block. The losses are hence logged scan_iterations steps at a time.
+    pretrain_scan = constants.pmap(
+        make_pretrain_scan(pretrain_mcmc_step, pretrain_step),
+        donate_argnums=(0, 1, 4),
+        static_broadcasted_argnums=5)
+    for t in range(0, iterations, scan_iterations):
+      block_iterations = min(scan_iterations, iterations - t)
+      params, opt_state_pt, data, sharded_key, logprob, losses = pretrain_scan(
+          params, opt_state_pt, data, sharded_key, logprob, block_iterations)
+      for i, loss in enumerate(np.asarray(losses[0])):
+        log_loss(t + i, float(loss))
+    return params, data
+
+  # Parameters, optimizer state and log probabilities are replaced by the
+  # outputs of each step, so let XLA reuse their buffers. The MCMC
+  # configurations are still required by the optimisation step after they are
+  # updated, so are not donated.
+  pretrain_step = constants.pmap(pretrain_step, donate_argnums=(2, 3))
+  pretrain_mcmc_step = constants.pmap(pretrain_mcmc_step, donate_argnums=3)
+  # pretrain_step is recompiled if the shape of any of its inputs changes.
+  target_shapes = tuple(data.shape[:-1] + (nspin, nspin) for nspin in electrons)
+
+  # Each iteration first moves the MCMC configurations using the current
+  # parameters and then optimises the network at the previous configurations.
+  # The HF orbitals at the new configurations are hence evaluated (by PySCF, on
+  # host) in a background thread whilst the optimisation step runs on device.
+  with futures.ThreadPoolExecutor(max_workers=1) as executor:
+    next_target = executor.submit(eval_orbitals, scf_approx, data, electrons)
+    for t in range(iterations):
+      sharded_key, subkeys = kfac_jax.utils.p_split(sharded_key)
+      new_data, logprob = pretrain_mcmc_step(params, data, subkeys, logprob)
+      target = next_target.result()
+      if tuple(x.shape for x in target) != target_shapes:
+        raise ValueError(
+            f'HF orbitals have shapes {tuple(x.shape for x in target)}, '
+            f'expected {target_shapes}.')
+      if t < iterations - 1:
+        next_target = executor.submit(
+            eval_orbitals, scf_approx, new_data, electrons)
+      params, opt_state_pt, loss = pretrain_step(data, target, params,
+                                                 opt_state_pt)
+      data = new_data
+      # Transfer the loss to host once and reuse it for all logging.
+      log_loss(t, float(loss[0]))
   return params, data
@@ -0,0 +1,327 @@
+# Copyright 2022 DeepMind Technologies Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for ferminet.pretrain."""
+
+import functools
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from ferminet import envelopes
+from ferminet import mcmc
+from ferminet import networks
+from ferminet import pretrain
+from ferminet.utils import system
+import jax
+import jax.numpy as jnp
+import numpy as np
+import optax
+import pyscf
+
+
+def _dot_general_dtypes(jaxpr):
+  """Returns the output dtypes of all dot_general ops in jaxpr."""
+  dtypes = []
+  for eqn in jaxpr.eqns:
+    if eqn.primitive.name == 'dot_general':
+      dtypes.append(eqn.outvars[0].aval.dtype)
+  for subjaxpr in jax.core.subjaxprs(jaxpr):
+    dtypes.extend(_dot_general_dtypes(subjaxpr))
+  return dtypes
+
+
+class PretrainTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    # disable use of temp directory in pyscf.
+    pyscf.lib.param.TMPDIR = None
+
+  def _make_lih(self, full_det, origin=(0., 0., 0.), determinants=2):
+    """Returns the HF solution, network components and data for LiH."""
+    molecule = [
+        system.Atom('Li', origin),
+        system.Atom('H', (origin[0], origin[1], origin[2] + 3.015))
+    ]
+    electrons = (2, 2)
+    hf = pretrain.get_hf(molecule, electrons, basis='sto-3g')
+    atoms = jnp.asarray([atom.coords for atom in molecule])
+    charges = jnp.asarray([atom.charge for atom in molecule])
+    network_init, _, options = networks.make_fermi_net(
+        atoms, electrons, charges, full_det=full_det,
+        hidden_dims=((16, 4), (16, 4)), determinants=determinants)
+    params = network_init(jax.random.PRNGKey(0))
+    orbitals = functools.partial(
+        networks.fermi_net_orbitals,
+        atoms=atoms,
+        nspins=electrons,
+        options=options)
+    batch_orbitals = jax.vmap(
+        lambda params, data: orbitals(params, data)[0], in_axes=(None, 0))
+    data = jax.random.normal(jax.random.PRNGKey(1), (8, sum(electrons) * 3))
+    return hf, electrons, params, batch_orbitals, data
+
+  @parameterized.parameters('output', 'exact_cusp')
+  def test_batch_envelope_fn_lax_map(self, envelope_label):
+    atoms = jnp.asarray([[0., 0., 0.], [0., 0., 3.015]])
+    charges = jnp.asarray([3., 1.])
+    electrons = (2, 2)
+    envelope = {
+        'output': envelopes.make_output_envelope,
+        'exact_cusp': functools.partial(
+            envelopes.make_exact_cusp_envelope, electrons, charges),
+    }[envelope_label]()
+    params = envelope.init(natom=2, output_dims=sum(electrons))
+    # Perturb the parameters away from the (symmetric) initialisation.
+    key = jax.random.PRNGKey(0)
+    params = jax.tree_util.tree_map(
+        lambda x: x + 0.1 * jax.random.normal(key, x.shape), params)
+    data = jax.random.normal(jax.random.PRNGKey(1), (8, sum(electrons) * 3))
+    vmap_envelope_fn = pretrain.make_batch_envelope_fn(envelope, atoms)
+    lax_map_envelope_fn = pretrain.make_batch_envelope_fn(
+        envelope, atoms, use_lax_map=True)
+    expected = vmap_envelope_fn(params, data)
+    actual = lax_map_envelope_fn(params, data)
+    self.assertEqual(actual.shape, (8,))
+    np.testing.assert_allclose(actual, expected, atol=1.e-6, rtol=1.e-6)
+    # jax.lax.map is implemented as a scan over the batch.
+    jaxpr = jax.make_jaxpr(lax_map_envelope_fn)(params, data)
+    self.assertIn('scan', [eqn.primitive.name for eqn in jaxpr.jaxpr.eqns])
+
+  def test_batch_envelope_fn_lax_map_pre_orbital(self):
+    atoms = jnp.asarray([[0., 0., 0.]])
+    envelope = envelopes.make_isotropic_envelope()
+    with self.assertLogs(level='WARNING'):
+      batch_envelope_fn = pretrain.make_batch_envelope_fn(
+          envelope, atoms, use_lax_map=True)
+    data = jnp.ones((8, 9))
+    np.testing.assert_array_equal(batch_envelope_fn({}, data), np.zeros(8))
+
+  @parameterized.parameters(
+      {
+          'molecule': [system.Atom('H', (0, 0, 0))],
+          'electrons': (1, 0),
+      },
+      {
+          'molecule': [system.Atom('Li', (0, 0, 0))],
+          'electrons': (2, 1),
+      },
+      {
+          'molecule': [
+              system.Atom('Li', (0, 0, 0)),
+              system.Atom('H', (0, 0, 3.015))
+          ],
+          'electrons': (2, 2),
+      },
+  )
+  def test_make_eval_orbitals(self, molecule, electrons):
+    hf = pretrain.get_hf(molecule, electrons, basis='sto-3g')
+    # (ndevice, batch, nelec*3), as passed to the pmapped pretraining step.
+    pos = np.random.RandomState(0).standard_normal(
+        (2, 5, sum(electrons) * 3)).astype(np.float32)
+    expected = pretrain.eval_orbitals(hf, pos, electrons)
+    eval_orbitals_fn = jax.jit(pretrain.make_eval_orbitals(hf, electrons))
+    actual = eval_orbitals_fn(pos)
+    self.assertLen(actual, 2)
+    for spin, nspin in enumerate(electrons):
+      self.assertEqual(actual[spin].shape, (2, 5, nspin, nspin))
+      np.testing.assert_allclose(
+          actual[spin], expected[spin], atol=1.e-5, rtol=1.e-4)
+
+  @parameterized.parameters(False, True)
+  def test_pretrain_step_jax_hf_orbitals(self, full_det):
+    hf, electrons, params, batch_orbitals, data = self._make_lih(full_det)
+    target = pretrain.eval_orbitals(hf, data, electrons)
+    optimizer = optax.adam(3.e-4)
+    opt_state = optimizer.init(params)
+    batch_envelope_fn = lambda p, x: jnp.zeros(x.shape[:1])
+    pyscf_step = pretrain.make_pretrain_step(
+        batch_envelope_fn, batch_orbitals, optimizer.update, full_det=full_det)
+    jax_step = pretrain.make_pretrain_step(
+        batch_envelope_fn,
+        batch_orbitals,
+        optimizer.update,
+        full_det=full_det,
+        eval_orbitals_fn=pretrain.make_eval_orbitals(hf, electrons))
+    expected_params, _, expected_loss = pyscf_step(
+        data, target, params, opt_state)
+    # The target is evaluated within the step and the argument is ignored.
+    actual_params, _, actual_loss = jax_step(data, None, params, opt_state)
+    np.testing.assert_allclose(actual_loss, expected_loss, rtol=1.e-4)
+    jax.tree_util.tree_map(
+        functools.partial(np.testing.assert_allclose, atol=1.e-5),
+        actual_params, expected_params)
+
+  @parameterized.parameters(1, 3)
+  def test_pretrain_mcmc_step(self, steps):
+    atoms = jnp.asarray([[0., 0., 0.]])
+    charges = jnp.asarray([3.])
+    electrons = (2, 1)
+    network_init, signed_network, _ = networks.make_fermi_net(
+        atoms, electrons, charges, hidden_dims=((16, 4), (16, 4)),
+        determinants=2)
+    params = network_init(jax.random.PRNGKey(0))
+    batch_network = jax.vmap(
+        lambda p, x: signed_network(p, x)[1], in_axes=(None, 0))
+    data = jax.random.normal(jax.random.PRNGKey(1), (8, sum(electrons) * 3))
+    logprob = 2. * batch_network(params, data)
+    key = jax.random.PRNGKey(2)
+
+    pretrain_mcmc_step = pretrain.make_pretrain_mcmc_step(
+        batch_network, steps=steps)
+    new_data, new_logprob = pretrain_mcmc_step(params, data, key, logprob)
+
+    # The RNG state and log probabilities are carried between the moves.
+    expected_data, expected_logprob = data, logprob
+    for i in range(steps):
+      expected_data, key, expected_logprob, _ = mcmc.mh_update(
+          params, batch_network, expected_data, key, expected_logprob, 0., i=i)
+    np.testing.assert_allclose(new_data, expected_data, atol=1.e-5)
+    np.testing.assert_allclose(new_logprob, expected_logprob, atol=1.e-4)
+    np.testing.assert_allclose(
+        new_logprob, 2. * batch_network(params, new_data), atol=1.e-4)
+    # At least some of the proposed moves are accepted.
+    self.assertFalse(np.allclose(new_data, data))
+
+  def test_pretrain_step_envelope_shape(self):
+    hf, electrons, params, batch_orbitals, data = self._make_lih(False)
+    target = pretrain.eval_orbitals(hf, data, electrons)
+    optimizer = optax.adam(3.e-4)
+    opt_state = optimizer.init(params)
+    # An envelope of shape (batch, 1) would broadcast against the orbitals.
+    batch_envelope_fn = lambda p, x: jnp.zeros(x.shape[:1] + (1,))
+    pretrain_step = pretrain.make_pretrain_step(
+        batch_envelope_fn, batch_orbitals, optimizer.update)
+    with self.assertRaises(ValueError):
+      pretrain_step(data, target, params, opt_state)
+
+  def test_pretrain_scan(self):
+    molecule = [system.Atom('Li', (0, 0, 0))]
+    electrons = (2, 1)
+    hf = pretrain.get_hf(molecule, electrons, basis='sto-3g')
+    atoms = jnp.asarray([[0., 0., 0.]])
+    charges = jnp.asarray([3.])
+    network_init, signed_network, options = networks.make_fermi_net(
+        atoms, electrons, charges, hidden_dims=((16, 4), (16, 4)),
+        determinants=2)
+    params = network_init(jax.random.PRNGKey(0))
+    batch_network = jax.vmap(
+        lambda p, x: signed_network(p, x)[1], in_axes=(None, 0))
+    orbitals = functools.partial(
+        networks.fermi_net_orbitals,
+        atoms=atoms,
+        nspins=electrons,
+        options=options)
+    batch_orbitals = jax.vmap(
+        lambda p, x: orbitals(p, x)[0], in_axes=(None, 0))
+    optimizer = optax.adam(3.e-4)
+    pretrain_mcmc_step = pretrain.make_pretrain_mcmc_step(batch_network)
+    pretrain_step = pretrain.make_pretrain_step(
+        pretrain.make_batch_envelope_fn(options.envelope, atoms),
+        batch_orbitals,
+        optimizer.update,
+        full_det=options.full_det,
+        eval_orbitals_fn=pretrain.make_eval_orbitals(hf, electrons))
+    data = jax.random.normal(jax.random.PRNGKey(1), (8, sum(electrons) * 3))
+    logprob = 2. * batch_network(params, data)
+    key = jax.random.PRNGKey(2)
+    opt_state = optimizer.init(params)
+
+    pretrain_scan = jax.jit(
+        pretrain.make_pretrain_scan(pretrain_mcmc_step, pretrain_step),
+        static_argnums=5)
+    actual = pretrain_scan(params, opt_state, data, key, logprob, 3)
+
+    expected_losses = []
+    for _ in range(3):
+      key, subkey = jax.random.split(key)
+      new_data, logprob = pretrain_mcmc_step(params, data, subkey, logprob)
+      params, opt_state, loss = pretrain_step(data, None, params, opt_state)
+      data = new_data
+      expected_losses.append(loss)
+    expected_losses = jnp.stack(expected_losses)
+    expected = (params, opt_state, data, key, logprob, expected_losses)
+    self.assertEqual(actual[-1].shape, (3,))
+    jax.tree_util.tree_map(
+        functools.partial(np.testing.assert_allclose, atol=1.e-5, rtol=1.e-5),
+        actual, expected)
+
+  @parameterized.parameters(False, True)
+  def test_bfloat16_orbitals(self, full_det):
+    hf, electrons, params, batch_orbitals, data = self._make_lih(full_det)
+    target = pretrain.eval_orbitals(hf, data, electrons)
+    optimizer = optax.adam(3.e-4)
+    opt_state = optimizer.init(params)
+    batch_envelope_fn = lambda p, x: jnp.zeros(x.shape[:1])
+
+    losses = []
+    for bfloat16_orbitals in (False, True):
+      pretrain_step = pretrain.make_pretrain_step(
+          batch_envelope_fn,
+          batch_orbitals,
+          optimizer.update,
+          full_det=full_det,
+          bfloat16_orbitals=bfloat16_orbitals)
+      jaxpr = jax.make_jaxpr(pretrain_step)(data, target, params, opt_state)
+      dtypes = _dot_general_dtypes(jaxpr.jaxpr)
+      expected_dtype = jnp.bfloat16 if bfloat16_orbitals else jnp.float32
+      self.assertNotEmpty(dtypes)
+      self.assertTrue(
+          all(dtype == expected_dtype for dtype in dtypes),
+          msg=f'dot_general dtypes: {dtypes}')
+      new_params, _, loss = pretrain_step(data, target, params, opt_state)
+      self.assertEqual(loss.dtype, jnp.float32)
+      jax.tree_util.tree_map(
+          lambda x: self.assertEqual(x.dtype, jnp.float32), new_params)
+      losses.append(loss)
+    np.testing.assert_allclose(losses[1], losses[0], rtol=2.e-2)
+
+  def test_bfloat16_orbitals_near_nucleus(self):
+    origin = (0., 0., 10.)
+    _, electrons, params, batch_orbitals, _ = self._make_lih(
+        full_det=False, origin=origin, determinants=1)
+    # Electrons close to a nucleus away from the origin, where the displacements
+    # are small compared to the absolute coordinates.
+    nelectrons = sum(electrons)
+    data = jnp.asarray(origin) + 0.01 * jax.random.normal(
+        jax.random.PRNGKey(1), (8, nelectrons, 3))
+    data = jnp.reshape(data, (8, nelectrons * 3))
+    # Fit to the float32 orbitals, so the loss is the error in the bfloat16
+    # orbitals.
+    target = [orbital[:, 0] for orbital in batch_orbitals(params, data)]
+    scale = sum(jnp.mean(t**2) for t in target)
+    optimizer = optax.adam(3.e-4)
+    opt_state = optimizer.init(params)
+    batch_envelope_fn = lambda p, x: jnp.zeros(x.shape[:1])
+
+    input_dtypes = []
+    def recording_batch_orbitals(p, x):
+      input_dtypes.append(
+          (x.dtype, jax.tree_util.tree_leaves(p['envelope'])[0].dtype))
+      return batch_orbitals(p, x)
+
+    pretrain_step = pretrain.make_pretrain_step(
+        batch_envelope_fn,
+        recording_batch_orbitals,
+        optimizer.update,
+        bfloat16_orbitals=True)
+    _, _, loss = pretrain_step(data, target, params, opt_state)
+    # The electron positions and envelope are passed to the network in float32.
+    self.assertEqual(input_dtypes, [(jnp.float32, jnp.float32)])
+    # Rounding the positions themselves to bfloat16 gives roughly 7e-5.
+    self.assertLess(loss / scale, 4.e-5)
+
+
+if __name__ == '__main__':
+  absltest.main()
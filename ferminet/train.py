@@ -457,7 +457,12 @@ def train(cfg: ml_collections.ConfigDict, writer_manager=None):
         atoms=atoms,
         electrons=cfg.system.electrons,
         scf_approx=hartree_fock,
-        iterations=cfg.pretrain.iterations)
+        iterations=cfg.pretrain.iterations,
+        jax_hf_orbitals=cfg.pretrain.jax_hf_orbitals,
+        use_lax_map=cfg.pretrain.use_lax_map,
+        mcmc_steps=cfg.pretrain.mcmc_steps,
+        bfloat16_orbitals=cfg.pretrain.bfloat16_orbitals,
+        scan_iterations=cfg.pretrain.scan_iterations)
 
   # Main training
 
@@ -29,13 +29,68 @@
 #   are solutions to the Hartree-Fock equations.
 
 
-from typing import Sequence, Tuple, Optional
+import functools
+from typing import Callable, List, Mapping, Sequence, Tuple, Optional
 
 from absl import logging
 from ferminet.utils import system
+import jax.numpy as jnp
 import numpy as np
 import pyscf
 
+# Normalisation factors libcint includes in s and p Gaussian-type orbitals
+# (see CINTcommon_fac_sp).
+_COMMON_FAC_SP = {0: 0.282094791773878143, 1: 0.488602511902919921}
+
+# Contracted GTOs of each angular momentum, l, as (centers, exponents,
+# coefficients) arrays of shape (nfunc, 3), (nfunc, nprim), (nfunc, nprim),
+# where nfunc is the number of contracted functions with angular momentum l.
+# Contractions with fewer than nprim primitives are padded with zero
+# coefficients.
+GtoShells = Mapping[int, Tuple[np.ndarray, np.ndarray, np.ndarray]]
+
+
+def _cartesian_powers(l: int) -> List[Tuple[int, int, int]]:
+  """Returns powers of (x, y, z) of Cartesian GTOs in PySCF order."""
+  return [(lx, ly, l - lx - ly)
+          for lx in range(l, -1, -1)
+          for ly in range(l - lx, -1, -1)]
+
+
+def _pad_primitives(x: np.ndarray, nprim: int) -> np.ndarray:
+  """Pads the primitives of a contracted GTO with zeros up to nprim."""
+  return np.pad(x, (0, nprim - len(x)))
+
+
+def eval_cartesian_gtos(shells: GtoShells,
+                        positions: jnp.ndarray) -> jnp.ndarray:
+  """Evaluates Cartesian Gaussian-type orbitals in JAX.
+
+  Args:
+    shells: contracted GTOs grouped by angular momentum.
+    positions: array of shape (N, 3) of the positions at which to evaluate the
+      GTOs.
+
+  Returns:
+    array of shape (N, M), where M is the number of Cartesian GTOs. GTOs are
+    ordered by angular momentum (in the order of shells), then by contracted
+    function and then by Cartesian component.
+  """
+  values = []
+  # Angular momenta are evaluated separately so each is a static, branch-free
+  # kernel when traced.
+  for l, (centers, exponents, coeffs) in shells.items():
+    disp = positions[:, None, :] - centers  # (N, nfunc, 3)
+    r2 = jnp.sum(disp**2, axis=-1, keepdims=True)
+    radial = jnp.sum(coeffs * jnp.exp(-exponents * r2), axis=-1)
+    angular = jnp.stack([
+        disp[..., 0]**lx * disp[..., 1]**ly * disp[..., 2]**lz
+        for lx, ly, lz in _cartesian_powers(l)
+    ], axis=-1)
+    values.append(
+        jnp.reshape(radial[..., None] * angular, (positions.shape[0], -1)))
+  return jnp.concatenate(values, axis=-1)
+
 
 class Scf:
   """Helper class for running Hartree-Fock (self-consistent field) with pyscf.
@@ -171,3 +226,71 @@ class Scf:
       # duplicate for beta electrons.
       mo_values *= 2
     return mo_values
+
+  def make_jax_eval_mos(
+      self) -> Callable[[jnp.ndarray], Tuple[jnp.ndarray, jnp.ndarray]]:
+    """Creates a JAX function to evaluate the Hartree-Fock orbitals.
+
+    The basis set and molecular orbital coefficients are extracted from PySCF,
+    so the returned function can be jitted, vmapped and pmapped, and run on
+    accelerators.
+
+    Returns:
+      Callable with signature f(positions), where positions is an array of
+      shape (N, 3), which returns the same as eval_mos (with deriv=False).
+
+    Raises:
+      RuntimeError: If Hartree-Fock calculation has not been performed using
+        `run`.
+      NotImplementedError: If Hartree-Fock calculation used Cartesian
+        Gaussian-type orbitals as the underlying basis set.
+    """
+    if self.mean_field is None:
+      raise RuntimeError('Mean-field calculation has not been run.')
+    if self.restricted:
+      coeffs = (self.mean_field.mo_coeff,)
+    else:
+      coeffs = self.mean_field.mo_coeff
+    if self._mol.cart:
+      raise NotImplementedError(
+          'Evaluation of molecular orbitals using cartesian GTOs.')
+
+    functions = {}
+    cart_index = {}
+    ao = 0
+    for ib in range(self._mol.nbas):
+      l = self._mol.bas_angular(ib)
+      exponents = self._mol.bas_exp(ib)
+      norm = pyscf.gto.gto_norm(l, exponents) * _COMMON_FAC_SP.get(l, 1.0)
+      ctr_coeffs = self._mol.bas_ctr_coeff(ib) * norm[:, None]
+      ncart = (l + 1) * (l + 2) // 2
+      for ctr_coeff in ctr_coeffs.T:
+        functions.setdefault(l, []).append(
+            (self._mol.bas_coord(ib), exponents, ctr_coeff))
+        cart_index.setdefault(l, []).append(np.arange(ao, ao + ncart))
+        ao += ncart
+
+    shells = {}
+    for l, l_functions in sorted(functions.items()):
+      centers, exponents, ctr_coeffs = zip(*l_functions)
+      nprim = max(len(x) for x in exponents)
+      pad = functools.partial(_pad_primitives, nprim=nprim)
+      shells[l] = (np.stack(centers), np.stack([pad(x) for x in exponents]),
+                   np.stack([pad(x) for x in ctr_coeffs]))
+    # Fold the transformation from Cartesian to spherical GTOs and the
+    # reordering of the Cartesian GTOs into the MO coefficients.
+    order = np.concatenate(
+        [np.concatenate(cart_index[l]) for l in shells])
+    cart2sph = self._mol.cart2sph_coeff()
+    coeffs = tuple(np.matmul(cart2sph, coeff)[order] for coeff in coeffs)
+    restricted = self.restricted
+
+    def eval_mos(positions: jnp.ndarray) -> Tuple[jnp.ndarray, jnp.ndarray]:
+      ao_values = eval_cartesian_gtos(shells, positions)
+      mo_values = tuple(jnp.matmul(ao_values, coeff) for coeff in coeffs)
+      if restricted:
+        # duplicate for beta electrons.
+        mo_values *= 2
+      return mo_values
+
+    return eval_mos
@@ -19,6 +19,7 @@ from absl.testing import absltest
 from absl.testing import parameterized
 from ferminet.utils import scf
 from ferminet.utils import system
+import jax
 import numpy as np
 import pyscf
 
@@ -97,6 +98,47 @@ class ScfTest(parameterized.TestCase):
       # Evaluate npts points on M orbitals/functions - (npts, M) array.
       self.assertEqual(spin_mo_vals.shape, (npts, hf._mol.nao_nr()))
 
+  @parameterized.parameters(
+      {
+          'molecule': [system.Atom('Li', (0, 0, 0))],
+          'nelectrons': (2, 1),
+          'basis': 'sto-3g',
+          'restricted': False,
+      },
+      {
+          'molecule': [
+              system.Atom('N', (0, 0, 0)),
+              system.Atom('O', (0, 0, 2.1))
+          ],
+          'nelectrons': (8, 7),
+          'basis': 'cc-pvdz',
+          'restricted': False,
+      },
+      {
+          'molecule': [system.Atom('Ne', (0, 0, 0))],
+          'nelectrons': (5, 5),
+          'basis': 'cc-pvtz',
+      },
+  )
+  def test_jax_eval_mos(self,
+                        molecule: List[system.Atom],
+                        nelectrons: Tuple[int, int],
+                        basis: str,
+                        restricted: bool = True):
+    """Tests the JAX evaluation of the HF orbitals agrees with PySCF."""
+    npts = 100
+    xs = np.random.randn(npts, 3)
+    hf = scf.Scf(molecule=molecule,
+                 nelectrons=nelectrons,
+                 basis=basis,
+                 restricted=restricted)
+    hf.run()
+    expected_mo_vals = hf.eval_mos(xs)
+    mo_vals = jax.jit(hf.make_jax_eval_mos())(xs)
+    self.assertLen(mo_vals, 2)
+    for expected, actual in zip(expected_mo_vals, mo_vals):
+      np.testing.assert_allclose(actual, expected, atol=1.e-5, rtol=1.e-4)
+
 
 if __name__ == '__main__':
   absltest.main()